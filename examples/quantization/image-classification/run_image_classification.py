@@ -16,6 +16,9 @@
 
 """ Finetuning the library models for image classification."""
 # You can also adapt this script on your own image classification task. Pointers for this are left as comments.
+import gc
+import hashlib
+import io
 import json
 import logging
 import os
@@ -23,15 +26,14 @@ import sys
 from dataclasses import dataclass, field
 from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import datasets
 import numpy as np
-import torch
 import transformers
-from datasets import load_dataset
+from datasets import Dataset, load_dataset
 from evaluate import load
-from torchvision.transforms import CenterCrop, Compose, Normalize, Resize, ToTensor
+from PIL import Image
 from transformers import AutoConfig, AutoFeatureExtractor, EvalPrediction, HfArgumentParser, TrainingArguments
 from transformers.utils.versions import require_version
 
@@ -44,6 +46,113 @@ logger = logging.getLogger(__name__)
 
 require_version("datasets>=2.0.0", "To fix: pip install -r examples/pytorch/image-classification/requirements.txt")
 
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class ImageTransforms:
+    """
+    Resizes the shortest edge of each image of a batch to `image_size`, center crops it to `image_size` x
+    `image_size` and normalizes the batch into a float32 NCHW array.
+
+    Resize and crop are done on uint8 pixels with Pillow, or with OpenCV for the undecoded images, only the
+    normalization works on float32 values.
+
+    Args:
+        image_size (`int`):
+            The size of the resulting square images.
+        image_mean (`List[float]`):
+            The per-channel mean used to normalize the images.
+        image_std (`List[float]`):
+            The per-channel standard deviation used to normalize the images.
+    """
+
+    def __init__(self, image_size: int, image_mean: List[float], image_std: List[float]):
+        self.image_size = image_size
+        # Fold the [0, 255] -> [0, 1] rescaling into the normalization constants so that the uint8 pixels are
+        # normalized in a single pass: (pixel / 255 - mean) / std == (pixel - mean * 255) * (1 / std / 255)
+        self.mean = np.asarray(image_mean, dtype=np.float32).reshape(3, 1, 1) * 255
+        self.inv_std = (1.0 / np.asarray(image_std, dtype=np.float32)).reshape(3, 1, 1) / 255
+
+    def _resized_size(self, width: int, height: int) -> Tuple[int, int]:
+        # Same output size as `torchvision.transforms.Resize(image_size)`
+        if width <= height:
+            return self.image_size, int(self.image_size * height / width)
+        return int(self.image_size * width / height), self.image_size
+
+    def resize_and_crop(self, image: Union[Image.Image, Dict[str, Any]]) -> np.ndarray:
+        """Returns the resized and center cropped image as an uint8 HWC array."""
+        array = None
+        if isinstance(image, dict):
+            # Undecoded image, only used when decoding with OpenCV
+            if image["bytes"] is not None:
+                array = cv2.imdecode(np.frombuffer(image["bytes"], np.uint8), cv2.IMREAD_COLOR)
+            else:
+                array = cv2.imread(image["path"], cv2.IMREAD_COLOR)
+
+            if array is None:
+                # The image format is not supported by OpenCV, decode it with Pillow instead
+                image = Image.open(io.BytesIO(image["bytes"]) if image["bytes"] is not None else image["path"])
+            else:
+                array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+                height, width = array.shape[:2]
+                resized_size = self._resized_size(width, height)
+                # Unlike INTER_LINEAR, INTER_AREA antialiases when shrinking, as Pillow's bilinear resize does
+                interpolation = cv2.INTER_AREA if resized_size[0] < width else cv2.INTER_LINEAR
+                array = cv2.resize(array, resized_size, interpolation=interpolation)
+
+        if array is None:
+            image = image.convert("RGB")
+            image = image.resize(self._resized_size(*image.size), resample=Image.BILINEAR)
+            array = np.asarray(image)
+
+        height, width = array.shape[:2]
+        top = int(round((height - self.image_size) / 2.0))
+        left = int(round((width - self.image_size) / 2.0))
+        return array[top : top + self.image_size, left : left + self.image_size]
+
+    def normalize(self, pixels: np.ndarray) -> np.ndarray:
+        """Normalizes a NCHW batch of uint8 pixels into a contiguous float32 array."""
+        # The uint8 pixels are promoted to float32 by the subtraction, no explicit cast is needed
+        normalized = np.empty(pixels.shape, dtype=np.float32)
+        np.subtract(pixels, self.mean, out=normalized)
+        np.multiply(normalized, self.inv_std, out=normalized)
+        return normalized
+
+    def __call__(self, images: List[Union[Image.Image, Dict[str, Any]]]) -> np.ndarray:
+        # Resize and crop the images into a single preallocated uint8 batch, then normalize the whole batch at once
+        pixels = np.empty((len(images), self.image_size, self.image_size, 3), dtype=np.uint8)
+        for i in range(len(images)):
+            pixels[i] = self.resize_and_crop(images[i])
+        return self.normalize(pixels.transpose(0, 3, 1, 2))
+
+
+def preprocess_function(example_batch, transforms):
+    """Apply transforms across a batch, replacing the images by their pixel values."""
+    example_batch["pixel_values"] = transforms(example_batch.pop("image"))
+    return example_batch
+
+
+def cache_pixel_values(example_batch, indices, transforms, cache_file):
+    """Preprocesses a batch of calibration images and writes their pixel values into the memory-mapped cache."""
+    # Defined at module level so that it can be pickled and sent to the `datasets.map` worker processes, each of them
+    # writing a disjoint set of rows of the cache
+    pixel_values = np.load(cache_file, mmap_mode="r+")
+    pixel_values[indices] = preprocess_function(example_batch, transforms)["pixel_values"]
+    pixel_values.flush()
+
+
+def load_pixel_values(example_batch, pixel_values):
+    """Gathers the cached pixel values of a batch of calibration samples."""
+    return {"pixel_values": pixel_values[example_batch["index"]]}
+
+
+def collate_function(example):
+    """Returns the evaluation samples as is, without converting them to torch tensors."""
+    return example
+
 
 @dataclass
 class DataTrainingArguments:
@@ -71,6 +180,20 @@ class DataTrainingArguments:
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached preprocessed datasets or not."}
     )
+    preprocessing_num_workers: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "The number of processes to use for the preprocessing. Defaults to the number of available CPUs, "
+            "capped at 8."
+        },
+    )
+    use_opencv: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to decode and resize the images with OpenCV instead of Pillow. The resulting pixel values "
+            "slightly differ from the Pillow ones."
+        },
+    )
     max_eval_samples: Optional[int] = field(
         default=None,
         metadata={
@@ -126,7 +249,8 @@ class OptimizationArguments:
         default="minmax_asym",
         metadata={
             "help": "The method chosen to calculate the activation quantization parameters using the calibration "
-            "dataset. Current supported calibration methods are minmax, entropy and percentile."
+            "dataset. Current supported calibration methods are minmax_asym, minmax_sym, percentile_asym and "
+            "percentile_sym. The symmetric methods only track the absolute maximum of each tensor."
         },
     )
     num_calibration_samples: int = field(
@@ -141,13 +265,23 @@ class OptimizationArguments:
         },
     )
     calibration_batch_size: int = field(
-        default=1,
-        metadata={"help": "The batch size for the calibration step."},
+        default=16,
+        metadata={
+            "help": "The batch size for the calibration step, i.e. the number of samples preprocessed and converted "
+            "at once."
+        },
     )
     calibration_histogram_percentile: float = field(
         default=99.999,
         metadata={"help": "The percentile used for the percentile calibration method."},
     )
+    no_calib_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to recompute the calibration ranges even if they were cached in the output directory by a "
+            "previous run with the same calibration parameters."
+        },
+    )
 
 
 def main():
@@ -156,7 +290,7 @@ def main():
     if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
         # If we pass only one argument to the script and it's the path to a json file,
         # let's parse it to get our arguments.
-        model_args, data_args, training_args, optim_args, onnx_export_args = parser.parse_json_file(
+        model_args, data_args, training_args, optim_args = parser.parse_json_file(
             json_file=os.path.abspath(sys.argv[1])
         )
     else:
@@ -210,30 +344,21 @@ def main():
         # See more about loading custom images at
         # https://huggingface.co/docs/datasets/v2.0.0/en/image_process#imagefolder.
 
+    if data_args.use_opencv:
+        if cv2 is None:
+            raise ImportError("--use_opencv requires OpenCV, please install it with `pip install opencv-python`.")
+        # Keep the encoded images, they are decoded by OpenCV during the preprocessing
+        dataset = dataset.cast_column("image", datasets.Image(decode=False))
+
     labels_column = (
         "labels" if "labels" in dataset["validation"].column_names else dataset["validation"].column_names[1]
     )
 
     feature_extractor = AutoFeatureExtractor.from_pretrained(model_args.model_name_or_path)
 
-    # Define torchvision transforms to be applied to each image.
-    normalize = Normalize(mean=feature_extractor.image_mean, std=feature_extractor.image_std)
+    # Define the transforms to be applied to each image.
     image_size = feature_extractor.size["shortest_edge"]
-    transforms = Compose(
-        [
-            Resize(image_size),
-            CenterCrop(image_size),
-            ToTensor(),
-            normalize,
-        ]
-    )
-
-    def preprocess_function(example_batch):
-        """Apply transforms across a batch."""
-        example_batch["pixel_values"] = [
-            transforms(image.convert("RGB")).to(torch.float32).numpy() for image in example_batch["image"]
-        ]
-        return example_batch
+    transforms = ImageTransforms(image_size, feature_extractor.image_mean, feature_extractor.image_std)
 
     metric = load("accuracy")
 
@@ -264,27 +389,31 @@ def main():
 
     calibration_dataset = dataset["train"]
     if optim_args.num_calibration_samples is not None:
-        calibration_dataset = calibration_dataset.shuffle(seed=training_args.seed).select(
-            range(optim_args.num_calibration_samples)
-        )
-
-    # all images are loaded in memory, which could prove expensive if num_calibration_samples is large
-    calibration_dataset = calibration_dataset.map(
-        partial(preprocess_function),
-        batched=True,
-        load_from_cache_file=not data_args.overwrite_cache,
-        desc="Running preprocessing on calibration dataset",
+        # Only draw the selected indices instead of shuffling the whole split
+        rng = np.random.default_rng(training_args.seed)
+        num_samples = min(optim_args.num_calibration_samples, len(calibration_dataset))
+        indices = rng.choice(len(calibration_dataset), size=num_samples, replace=False)
+        calibration_dataset = calibration_dataset.select(indices.tolist())
+
+    # Remove the unnecessary columns of the calibration dataset before the calibration step, only the images are
+    # needed to compute the model inputs
+    calibration_dataset = calibration_dataset.remove_columns(
+        [column for column in calibration_dataset.column_names if column != "image"]
     )
 
-    # Remove the unnecessary columns of the calibration dataset before the calibration step
-    calibration_dataset = quantizer.clean_calibration_dataset(calibration_dataset)
-
     # Create the calibration configuration given the selected calibration method
     if optim_args.calibration_method == "percentile_asym":
         calibration_config = AutoCalibrationConfig.percentiles_asym(
             calibration_dataset,
             percentile=optim_args.calibration_histogram_percentile,
         )
+    elif optim_args.calibration_method == "percentile_sym":
+        calibration_config = AutoCalibrationConfig.percentiles_sym(
+            calibration_dataset,
+            percentile=optim_args.calibration_histogram_percentile,
+        )
+    elif optim_args.calibration_method == "minmax_sym":
+        calibration_config = AutoCalibrationConfig.minmax_sym(calibration_dataset)
     else:
         calibration_config = AutoCalibrationConfig.minmax_asym(calibration_dataset)
 
@@ -295,22 +424,105 @@ def main():
             f"{len(calibration_dataset)}."
         )
 
-    for i in range(optim_args.num_calibration_shards):
-        shard = calibration_dataset.shard(optim_args.num_calibration_shards, i)
-        quantizer.partial_fit(
-            dataset=shard,
-            calibration_config=calibration_config,
-            batch_size=optim_args.calibration_batch_size,
+    # The preprocessed calibration images only depend on the model, the calibration samples and the preprocessing,
+    # cache them in a .npy file, memory-mapped back on repeated runs instead of decoding the images again
+    pixel_values_cache_key = hashlib.sha256(
+        json.dumps(
+            [
+                model_args.model_name_or_path,
+                data_args.dataset_name,
+                data_args.train_dir,
+                image_size,
+                feature_extractor.image_mean,
+                feature_extractor.image_std,
+                data_args.use_opencv,
+                optim_args.num_calibration_samples,
+                training_args.seed,
+            ]
+        ).encode()
+    ).hexdigest()
+    pixel_values_cache_file = os.path.join(training_args.output_dir, f"calib_{pixel_values_cache_key}.npy")
+
+    # The calibration ranges additionally depend on the calibration method and the sharding of the calibration
+    # dataset, cache them to skip the calibration step on repeated runs
+    calibration_cache_key = hashlib.sha256(
+        json.dumps(
+            [
+                pixel_values_cache_key,
+                optim_args.calibration_method,
+                optim_args.calibration_histogram_percentile,
+                optim_args.num_calibration_shards,
+            ]
+        ).encode()
+    ).hexdigest()
+    calibration_cache_file = os.path.join(training_args.output_dir, f"calib_cache_{calibration_cache_key}.json")
+
+    if not optim_args.no_calib_cache and os.path.isfile(calibration_cache_file):
+        logger.info(f"Loading the calibration ranges from {calibration_cache_file}")
+        with open(calibration_cache_file) as f:
+            ranges = {name: tuple(tensor_range) for name, tensor_range in json.load(f).items()}
+    else:
+        if data_args.overwrite_cache or not os.path.isfile(pixel_values_cache_file):
+            logger.info(f"Caching the preprocessed calibration images in {pixel_values_cache_file}")
+            # Write to a temporary file first so that an interrupted run does not leave an incomplete cache behind
+            tmp_cache_file = f"{pixel_values_cache_file}.tmp"
+            pixel_values = np.lib.format.open_memmap(
+                tmp_cache_file,
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(calibration_dataset), 3, image_size, image_size),
+            )
+            pixel_values.flush()
+            del pixel_values
+
+            num_proc = data_args.preprocessing_num_workers
+            if num_proc is None:
+                num_proc = min(os.cpu_count() or 1, 8)
+
+            # The images are preprocessed in parallel worker processes, batch by batch, directly into the cache file
+            # instead of being all loaded in memory beforehand
+            calibration_dataset.map(
+                cache_pixel_values,
+                with_indices=True,
+                batched=True,
+                batch_size=optim_args.calibration_batch_size,
+                num_proc=num_proc,
+                fn_kwargs={"transforms": transforms, "cache_file": tmp_cache_file},
+                load_from_cache_file=False,
+                desc="Running preprocessing on calibration dataset",
+            )
+            os.replace(tmp_cache_file, pixel_values_cache_file)
+
+        pixel_values = np.load(pixel_values_cache_file, mmap_mode="r")
+        calibration_dataset = Dataset.from_dict({"index": list(range(len(pixel_values)))}).with_transform(
+            partial(load_pixel_values, pixel_values=pixel_values)
         )
-    ranges = quantizer.compute_ranges()
+
+        for i in range(optim_args.num_calibration_shards):
+            shard = calibration_dataset.shard(optim_args.num_calibration_shards, i)
+            quantizer.partial_fit(
+                dataset=shard,
+                calibration_config=calibration_config,
+                batch_size=optim_args.calibration_batch_size,
+            )
+        ranges = quantizer.compute_ranges()
+        del shard, pixel_values
+
+        with open(calibration_cache_file, "w") as f:
+            json.dump({name: [float(v) for v in tensor_range] for name, tensor_range in ranges.items()}, f)
 
     # Apply quantization on the model
     quantizer.quantize(
         save_dir=training_args.output_dir,
         calibration_tensors_range=ranges,
         quantization_config=qconfig,
+        calibration_config=calibration_config,
     )
 
+    # Release the calibration data and the quantizer (holding the ONNX model) before the evaluation step
+    del quantizer, calibration_dataset, ranges, dataset["train"]
+    gc.collect()
+
     # Evaluation
     if training_args.do_eval:
         logger.info("*** Evaluate ***")
@@ -333,7 +545,19 @@ def main():
             )
 
         # Set the validation transforms
-        eval_dataset = eval_dataset.with_transform(preprocess_function)
+        eval_dataset = eval_dataset.with_transform(partial(preprocess_function, transforms=transforms))
+
+        if training_args.dataloader_num_workers > 0:
+            from torch.utils.data import DataLoader
+
+            # Preprocess the next samples in worker processes while the current ones are running on the NPU
+            eval_dataset = DataLoader(
+                eval_dataset,
+                batch_size=None,
+                num_workers=training_args.dataloader_num_workers,
+                prefetch_factor=4,
+                collate_fn=collate_function,
+            )
 
         furiosa_model = FuriosaAIModelForImageClassification(
             Path(training_args.output_dir) / "model_quantized.dfg",
@@ -89,6 +89,7 @@ class AutoCalibrationConfig:
             method=CalibrationMethod.MIN_MAX_ASYM,
         )
 
+    @staticmethod
     def minmax_sym(dataset: Dataset) -> CalibrationConfig:
         """
         Args:
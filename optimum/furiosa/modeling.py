@@ -13,7 +13,7 @@
 #  limitations under the License.
 
 import logging
-from typing import Callable, Dict, List, Optional, Union
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Union
 
 import numpy as np
 import torch
@@ -35,6 +35,9 @@ from .modeling_base import FuriosaAIBaseModel
 from .utils import FURIOSA_DTYPE_TO_NUMPY_DTYPE
 
 
+if TYPE_CHECKING:
+    from torch.utils.data import DataLoader
+
 logger = logging.getLogger(__name__)
 
 
@@ -99,13 +102,14 @@ class FuriosaAIModel(FuriosaAIBaseModel):
     def forward(self, *args, **kwargs):
         raise NotImplementedError
 
-    def evaluation_loop(self, dataset: Dataset):
+    def evaluation_loop(self, dataset: Union[Dataset, "DataLoader"]):
         """
         Run evaluation and returns metrics and predictions.
 
         Args:
-            dataset (`datasets.Dataset`):
-                Dataset to use for the evaluation step.
+            dataset (`datasets.Dataset` or `torch.utils.data.DataLoader`):
+                Dataset to use for the evaluation step. A `DataLoader` yielding the samples one by one (i.e. created
+                with `batch_size=None`) can be used to prefetch the samples in worker processes.
         """
         logger.info("***** Running evaluation *****")
 
@@ -13,6 +13,7 @@
 #  limitations under the License.
 
 import logging
+import math
 import os
 from pathlib import Path
 from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple, Union
@@ -38,7 +39,7 @@ LOGGER = logging.getLogger(__name__)
 
 
 class FuriosaAICalibrationDataReader:
-    __slots__ = ["batch_size", "dataset", "_dataset_iter", "input_datatypes"]
+    __slots__ = ["batch_size", "dataset", "_start", "_buffers", "input_datatypes"]
 
     def __init__(self, dataset: Dataset, input_datatypes, batch_size: int = 1):
         if dataset is None:
@@ -54,35 +55,40 @@ class FuriosaAICalibrationDataReader:
         self.input_datatypes = input_datatypes
         self.batch_size = batch_size
 
-        self._dataset_iter = iter(self.dataset)
+        self._start = 0
+        self._buffers = [None] * len(input_datatypes)
 
     def __len__(self):
-        return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
 
     def __next__(self):
-        featurized_samples = None
-        try:
-            featurized_samples = []
-            for _ in range(self.batch_size):
-                sample = next(self._dataset_iter)
-
-                input_list = [[] for i in range(len(sample))]
-                for i, name in enumerate(sample):
-                    input_list[i] += [sample[name]]
-                input_list = [
-                    np.array(d, onnx.mapping.TENSOR_TYPE_TO_NP_TYPE[self.input_datatypes[i]])
-                    for i, d in enumerate(input_list)
-                ]
-
-                featurized_samples.append(input_list)
-
-        except StopIteration:
+        if self._start >= len(self.dataset):
             raise StopIteration
 
-        if len(featurized_samples) > 0:
-            return featurized_samples
+        # Fetch the whole batch at once, so that the dataset formatting / transform is applied once per batch
+        batch = self.dataset[self._start : self._start + self.batch_size]
+        self._start += self.batch_size
 
-        raise StopIteration
+        # Convert each input of the batch into a single contiguous array and yield per-sample views of it
+        input_list = [self._to_input_array(i, batch[name]) for i, name in enumerate(batch)]
+        num_samples = len(input_list[0])
+
+        return [[inputs[j : j + 1] for inputs in input_list] for j in range(num_samples)]
+
+    def _to_input_array(self, index: int, column) -> np.ndarray:
+        dtype = onnx.mapping.TENSOR_TYPE_TO_NP_TYPE[self.input_datatypes[index]]
+        column = np.asarray(column)
+        if column.dtype == dtype and column.flags.c_contiguous:
+            return column
+
+        # The conversion is done in a buffer reused across batches, the returned array is thus only valid until the
+        # next batch is read
+        buffer = self._buffers[index]
+        if buffer is None or buffer.shape[1:] != column.shape[1:] or buffer.dtype != dtype:
+            buffer = np.empty((self.batch_size,) + column.shape[1:], dtype=dtype)
+            self._buffers[index] = buffer
+        np.copyto(buffer[: len(column)], column, casting="unsafe")
+        return buffer[: len(column)]
 
     def __iter__(self):
         return self
@@ -113,6 +119,7 @@ class FuriosaAIQuantizer(OptimumQuantizer):
                     "the quantized model harder to use because it will not be able to be loaded by an FuriosaAIModel without "
                     "having to specify the configuration explicitly."
                 )
+        self.onnx_model = None
         self._calibrator = None
         self._calibration_config = None
 
@@ -264,6 +271,7 @@ class FuriosaAIQuantizer(OptimumQuantizer):
         save_dir: Union[str, Path],
         file_suffix: Optional[str] = "quantized",
         calibration_tensors_range: Optional[Dict[str, Tuple[float, float]]] = None,
+        calibration_config: Optional[CalibrationConfig] = None,
     ) -> Path:
         """
         Quantizes a model given the optimization specifications defined in `quantization_config`.
@@ -278,10 +286,16 @@ class FuriosaAIQuantizer(OptimumQuantizer):
             calibration_tensors_range (`Optional[Dict[NodeName, Tuple[float, float]]]`, *optional*):
                 The dictionary mapping the nodes name to their quantization ranges, used and required only when applying
                 static quantization.
+            calibration_config (`Optional[CalibrationConfig]`, *optional*):
+                The configuration used to compute `calibration_tensors_range`, saved along with the quantized model.
+                Only needed when the ranges were not computed with this quantizer, e.g. when they were loaded from a
+                cache, otherwise the configuration given to `fit` or `partial_fit` is used.
 
         Returns:
             The path of the resulting quantized model.
         """
+        if calibration_config is not None:
+            self._calibration_config = calibration_config
 
         save_dir = Path(save_dir)
         save_dir.mkdir(parents=True, exist_ok=True)
@@ -341,13 +355,14 @@ class FuriosaAIQuantizer(OptimumQuantizer):
             preprocess_batch (`bool`, *optional*, defaults to `True`):
                 Whether the `preprocess_function` should be batched.
             seed (`int`, *optional*, defaults to 2016):
-                The random seed to use when shuffling the calibration dataset.
+                The random seed to use when sampling the calibration dataset.
             use_auth_token (`bool`, *optional*, defaults to `False`):
                 Whether to use the token generated when running `transformers-cli login` (necessary for some datasets
                 like ImageNet).
         Returns:
             The calibration `datasets.Dataset` to use for the post-training static quantization calibration
-            step.
+            step, formatted as numpy: its rows and slices are returned as `np.ndarray` instead of python lists, and
+            the format is kept by any subsequent `map`.
         """
         calib_dataset = load_dataset(
             dataset_name,
@@ -358,14 +373,19 @@ class FuriosaAIQuantizer(OptimumQuantizer):
 
         if num_samples is not None:
             num_samples = min(num_samples, len(calib_dataset))
-            calib_dataset = calib_dataset.shuffle(seed=seed).select(range(num_samples))
+            rng = np.random.default_rng(seed)
+            indices = rng.choice(len(calib_dataset), size=num_samples, replace=False)
+            calib_dataset = calib_dataset.select(indices.tolist())
 
         if preprocess_function is not None:
             processed_calib_dataset = calib_dataset.map(preprocess_function, batched=preprocess_batch)
         else:
             processed_calib_dataset = calib_dataset
 
-        return self.clean_calibration_dataset(processed_calib_dataset)
+        calib_dataset = self.clean_calibration_dataset(processed_calib_dataset)
+        # Return the model inputs as numpy arrays instead of nested python lists during the calibration step
+        calib_dataset.set_format(type="numpy", columns=calib_dataset.column_names)
+        return calib_dataset
 
     def clean_calibration_dataset(self, dataset: Dataset) -> Dataset:
         model = onnx.load(self.model_path)
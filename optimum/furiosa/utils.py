@@ -43,9 +43,19 @@ _HEAD_TO_AUTOMODELS = {
 }
 
 
-def export_model_to_onnx(model_id, save_dir, input_shape_dict, output_shape_dict, file_name="model.onnx"):
+def export_model_to_onnx(
+    model_id, save_dir, input_shape_dict, output_shape_dict, file_name="model.onnx", opset=None
+):
+    """
+    Exports a model to ONNX with static input and output shapes.
+
+    Args:
+        opset (`Optional[int]`, defaults to `None`):
+            The ONNX opset to export the model with. Defaults to the model ONNX config `DEFAULT_ONNX_OPSET`, as done by
+            `FuriosaAIBaseModel`. It should not exceed `MAX_ONNX_OPSET`, the highest opset supported by the Furiosa SDK.
+    """
     task = "image-classification"
-    main_export(model_id, save_dir, task=task)
+    main_export(model_id, save_dir, task=task, opset=opset)
 
     import onnx
     from onnx import shape_inference
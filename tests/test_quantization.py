@@ -18,7 +18,10 @@ import unittest
 from functools import partial
 from pathlib import Path
 
+import numpy as np
 import requests
+from datasets import Dataset
+from onnx import TensorProto
 from parameterized import parameterized
 from PIL import Image
 from transformers import AutoFeatureExtractor
@@ -30,9 +33,30 @@ from optimum.furiosa import (
     FuriosaAIQuantizer,
     QuantizationConfig,
 )
+from optimum.furiosa.quantization import FuriosaAICalibrationDataReader
 from optimum.furiosa.utils import export_model_to_onnx
 
 
+class FuriosaAICalibrationDataReaderTest(unittest.TestCase):
+    def test_batches(self):
+        pixel_values = np.random.rand(10, 3, 8, 8)
+        dataset = Dataset.from_dict({"pixel_values": pixel_values.tolist()})
+        reader = FuriosaAICalibrationDataReader(dataset, [TensorProto.FLOAT], batch_size=4)
+        self.assertEqual(len(reader), 3)
+
+        batch_sizes = []
+        num_samples = 0
+        for batch in reader:
+            batch_sizes.append(len(batch))
+            for sample in batch:
+                self.assertEqual(len(sample), 1)
+                self.assertEqual(sample[0].shape, (1, 3, 8, 8))
+                self.assertEqual(sample[0].dtype, np.float32)
+                np.testing.assert_allclose(sample[0][0], pixel_values[num_samples], rtol=1e-6)
+                num_samples += 1
+        self.assertEqual(batch_sizes, [4, 4, 2])
+
+
 class FuriosaAIQuantizationTest(unittest.TestCase):
     SUPPORTED_ARCHITECTURES = ((FuriosaAIModelForImageClassification, "fxmarty/resnet-tiny-beans"),)
 
@@ -91,3 +115,16 @@ class FuriosaAIQuantizationTest(unittest.TestCase):
 
             fai_outputs = fai_model_quantized(**inputs)
             self.assertIn("logits", fai_outputs)
+
+            # A new quantizer can quantize the model with precomputed ranges, without calling `fit`
+            quantizer = FuriosaAIQuantizer.from_pretrained(tmp_dir, file_name="model.onnx")
+            quantizer.quantize(
+                save_dir=output_dir,
+                calibration_tensors_range=ranges,
+                quantization_config=qconfig,
+                calibration_config=calibration_config,
+            )
+
+            fai_config = FuriosaAIConfig.from_pretrained(tmp_dir)
+            self.assertEqual(fai_config.to_dict(), expected_fai_config.to_dict())
+            assert os.path.isfile(output_dir.joinpath("model_quantized.dfg")) is True